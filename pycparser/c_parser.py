@@ -127,7 +127,7 @@ class CParser(PLYParser):
         # Keeps track of the last token given to yacc (the lookahead token)
         self._last_yielded_token = None
 
-    def parse(self, text, filename='', debug=False):
+    def parse(self, text, filename='', debug=False, scope=None):
         """ Parses C code and returns an AST.
 
             text:
@@ -139,10 +139,16 @@ class CParser(PLYParser):
 
             debug:
                 Debug flag to YACC
+
+            scope:
+                Names already declared at file scope, as left in
+                _scope_stack[0] by parsing the preceding part of the
+                same translation unit. Allows a translation unit to be
+                parsed in several pieces.
         """
         self.clex.filename = filename
         self.clex.reset_lineno()
-        self._scope_stack = [dict()]
+        self._scope_stack = [dict(scope or {})]
         self._last_yielded_token = None
         return self.cparser.parse(
                 input=text,
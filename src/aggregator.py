@@ -1,13 +1,45 @@
 import os
 import sys
+import json
+import heapq
+import pickle
+import tempfile
+import numpy as np
 import pandas as pd
 import argparse
 from extractor import FEATURES_HDR
+from timing import Stages
+# rows of a block written at a time, and sorted runs merged at a time
+CHUNK = 10000
+FAN_IN = 64
+# prefixes of the names a decompiler gives the functions of a stripped binary,
+# followed by '_' and their address
+NAME_RULES = {
+    'angr': 'sub|main',
+    'bn': 'sub|thunk|main',
+    'ghidra': 'FUN|thunk',
+    'ida': 'sub|main',
+    'radare2': 'fcn|main',
+    'retdec': 'function',
+}
+
+def read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
 
 class Features():
     def __init__(self, targets):
         self.decompilers = targets
         self.scores = []
+        self.schema = None
+        self.runs = None
+        self.tmp = None
+        self.count = 0
+        self.unmatched = dict()
     
     def process(self, data, target, filename):
         data.insert(0, '_decompiler', target)
@@ -15,38 +47,179 @@ class Features():
         self.scores.append(data)
 
     def process_stripped(self, data, target, filename):
-        funcs = []
-        for i, func in enumerate(data.values):
-            if func[0].startswith('fts_') or func[0].startswith('obstack_'):
-                func[0] = func[0].replace('_', '')
-            try:
-                funcname = '0x' + func[0].split('_')[1].lower().lstrip('0').zfill(6)
-                funcs.append(funcname)
-            except:
-                funcs.append(func[0])
-        data['_func_name'] = funcs
+        # names following the rule of the decompiler carry the address
+        names = data['_func_name']
+        rule = NAME_RULES.get(target, '|'.join(NAME_RULES.values()))
+        address = names.str.extract(r'^(?:%s)_0*([0-9a-fA-F]+)\Z' % rule, expand=False)
+        unmatched = address.isna()
+        self.unmatched[target] = self.unmatched.get(target, 0) + int(unmatched.sum())
+
+        # any other name is mapped to what follows its first '_', or kept as
+        # it is, with the gnulib names glued together
+        others = names[unmatched]
+        others = others.mask(others.str.startswith(('fts_', 'obstack_')), others.str.replace('_', '', regex=False))
+        address[unmatched] = others.str.extract(r'^[^_]*_0*([^_]*)', expand=False)
+        data['_func_name'] = ('0x' + address.str.lower().str.zfill(6)).fillna(others)
         data.insert(0, '_decompiler', target)
-        data.insert(1, '_binary', filename[:-4])
+        data.insert(1, '_binary', os.path.splitext(filename)[0])
         self.scores.append(data)
 
-    def collect(self, stripped):
+    def collect(self, stripped, fmt='csv', chunked=False):
+        if chunked:
+            self.tmp = tempfile.TemporaryDirectory()
+            (self.runs, samples) = (dict(), dict())
         for decompiler in self.decompilers:
             for filename in os.listdir(decompiler):
-                data = pd.read_csv(f'{decompiler}/{filename}', header=0, delimiter=',')
+                if not filename.endswith('.' + fmt):
+                    continue
+                if fmt == 'parquet':
+                    data = pd.read_parquet(f'{decompiler}/{filename}')
+                else:
+                    data = pd.read_csv(f'{decompiler}/{filename}', header=0, delimiter=',')
                 if stripped:
                     self.process_stripped(data, decompiler, filename)
                 else:
                     self.process(data, decompiler, filename)
-        
+                if chunked:
+                    data = self.scores.pop()
+                    # the dtypes a concat of every file gives only depend on the
+                    # dtypes of each file and on whether it is empty
+                    samples.setdefault((tuple(data.dtypes), data.empty), data.head(1))
+                    self.spill(data)
+
+        for (decompiler, count) in self.unmatched.items():
+            if count:
+                print('[-] %d function names of %s did not match its naming rule' % (count, decompiler), file=sys.stderr)
+        if chunked:
+            self.schema = pd.concat(samples.values()).iloc[:0]
+            self.merge_runs()
+            return
         self.scores = pd.concat(self.scores)
         self.scores.drop_duplicates(inplace=True)
 
-    def save(self, experiment):
-        target_name = os.path.join(os.path.dirname(sys.path[0]), 'eval', experiment, 'aggregated.csv')
+    def spill(self, data):
+        if data.empty:
+            return
+        # each file is sorted on its own into a run on disk, the runs of a
+        # binary are kept in the order the files are read
+        data = data.sort_values(by='_func_name', kind='stable')
+        runs = self.runs.setdefault(data['_binary'].iloc[0], [])
+        runs.append(os.path.join(self.tmp.name, str(sum(map(len, self.runs.values())))))
+        with open(runs[-1], 'wb') as f:
+            for i in range(0, len(data), CHUNK):
+                pickle.dump(data.iloc[i:i + CHUNK], f, pickle.HIGHEST_PROTOCOL)
+
+    def merge(self, runs, f):
+        # rows of the runs by function name, the earlier run first on a tie as
+        # a stable sort of all of them would leave them, and the first of
+        # identical rows only, which always share their name
+        def rows(run):
+            for chunk in read_run(run):
+                yield from chunk.itertuples(index=False, name=None)
+
+        k = self.schema.columns.get_loc('_func_name')
+        def key(row):
+            # rows without a name come last
+            return (row[k] != row[k], row[k] if row[k] == row[k] else '')
+
+        (block, seen, name, count) = ([], set(), None, 0)
+        for row in heapq.merge(*map(rows, runs), key=key):
+            if key(row) != name:
+                (seen, name) = (set(), key(row))
+            values = tuple(None if v != v else v for v in row)
+            if values in seen:
+                continue
+            seen.add(values)
+            block.append(row)
+            if len(block) == CHUNK:
+                pickle.dump(self.frame(block), f, pickle.HIGHEST_PROTOCOL)
+                (block, count) = ([], count + len(block))
+        if block:
+            pickle.dump(self.frame(block), f, pickle.HIGHEST_PROTOCOL)
+        return count + len(block)
+
+    def frame(self, rows):
+        # values keep their own type until they are given the dtype of their column
+        return pd.DataFrame(rows, columns=self.schema.columns, dtype=object).astype(self.schema.dtypes)
+
+    def merge_runs(self):
+        # binaries one at a time in sorted order, at most FAN_IN runs open at once
+        self.scores = os.path.join(self.tmp.name, 'aggregated')
+        with open(self.scores, 'wb') as f:
+            for binary in sorted(self.runs):
+                runs = self.runs.pop(binary)
+                while len(runs) > FAN_IN:
+                    merged = []
+                    for i in range(0, len(runs), FAN_IN):
+                        merged.append(runs[i] + '.')
+                        with open(merged[-1], 'wb') as m:
+                            self.merge(runs[i:i + FAN_IN], m)
+                        for run in runs[i:i + FAN_IN]:
+                            os.remove(run)
+                    runs = merged
+                self.count += self.merge(runs, f)
+                for run in runs:
+                    os.remove(run)
+
+    def blocks(self):
+        if self.runs is None:
+            yield self.scores
+        else:
+            yield from read_run(self.scores)
+
+    def save(self, experiment, fmt='csv', matrix=False):
+        target_name = os.path.join(os.path.dirname(sys.path[0]), 'eval', experiment, 'aggregated.' + fmt)
+        if self.runs is None:
+            self.scores.sort_values(by=['_binary','_func_name'], inplace=True)
+            (self.schema, self.count) = (self.scores.iloc[:0], len(self.scores))
+        if matrix:
+            self.save_matrix(os.path.splitext(target_name)[0])
+            return
+        if fmt == 'parquet':
+            self.save_parquet(target_name)
+            return
+
         with open(target_name, 'w') as f:
             f.write('_decompiler,_binary,_func_name,'+','.join(sorted(FEATURES_HDR[1:]))+',\n')
-            self.scores.sort_values(by=['_binary','_func_name'], inplace=True)
-            self.scores.to_csv(f, header=False, index=False)
+            for block in self.blocks():
+                block.to_csv(f, header=False, index=False)
+
+    def save_parquet(self, target_name):
+        if self.runs is None:
+            self.scores.to_parquet(target_name, index=False)
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        for block in self.blocks():
+            table = pa.Table.from_pandas(block, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(target_name, table.schema)
+            writer.write_table(table.cast(writer.schema))
+        if writer is None:
+            self.schema.to_parquet(target_name, index=False)
+        else:
+            writer.close()
+
+    def save_matrix(self, target_name):
+        # features by position as in the csv, one contiguous column each so
+        # that the evaluator only reads the columns it weighs
+        features = self.schema.iloc[:, 3:3 + len(FEATURES_HDR[1:])]
+        matrix = np.lib.format.open_memmap(target_name + '.npy', mode='w+', dtype=float,
+                                           shape=(self.count, features.shape[1]), fortran_order=True)
+        with open(target_name + '.idx.csv', 'w') as f:
+            f.write('decompiler,binary,address\n')
+            i = 0
+            for block in self.blocks():
+                matrix[i:i + len(block)] = block.iloc[:, 3:3 + len(FEATURES_HDR[1:])].to_numpy(dtype=float)
+                block.iloc[:, :3].to_csv(f, header=False, index=False)
+                i += len(block)
+        matrix.flush()
+
+        with open(target_name + '.json', 'w') as f:
+            json.dump({'features': sorted(FEATURES_HDR[1:]),
+                       'integer': [feature for (feature, dtype) in zip(sorted(FEATURES_HDR[1:]), features.dtypes)
+                                   if dtype.kind in 'iu']}, f)
 
 
 if __name__ == '__main__':
@@ -56,11 +229,21 @@ if __name__ == '__main__':
                             help='specify targets to relatively aggregate')
     parser.add_argument('-s', '--stripped', action='store_true', default=False,
                             help='process stripped functions')
+    parser.add_argument('-f', '--format', choices=['csv', 'parquet'], default='csv',
+                            help='format of the feature scores to read and of the aggregated file')
+    parser.add_argument('-m', '--matrix', action='store_true', default=False,
+                            help='save the aggregated feature scores as a memory-mappable matrix')
+    parser.add_argument('-c', '--chunked', action='store_true', default=False,
+                            help='aggregate one file at a time through sorted runs on disk to bound memory')
     args = parser.parse_args()
     
     os.chdir(os.path.join(os.path.dirname(sys.path[0]), 'extract', args.experiment))
 
+    stages = Stages(experiment=args.experiment)
     f = Features(args.targets)
-    f.collect(args.stripped)
-    f.save(args.experiment)
+    with stages.stage('aggregate.collect'):
+        f.collect(args.stripped, args.format, args.chunked)
+    with stages.stage('aggregate.save'):
+        f.save(args.experiment, args.format, args.matrix)
+    stages.report()
 
@@ -0,0 +1,330 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import subprocess
+import pandas as pd
+from pycparser import c_ast, c_generator
+
+# how each decompiler writes a stripped binary: the fake header it is parsed
+# with, whether the file redefines the __int types after it, the names of the
+# functions, locals and parameters, and the types of its declarations and casts
+STYLES = {
+    'angr': {
+        'header': 'decompile_angr.h', 'defines': True, 'return': 'int',
+        'function': 'sub_%x', 'local': 'v%d', 'param': 'a%d',
+        'types': ['unsigned long long', 'unsigned long', 'unsigned int', 'char', 'int'],
+    },
+    'bn': {
+        'header': 'decompile_bn.h', 'defines': False, 'return': 'int64_t',
+        'function': 'sub_%x', 'local': 'var_%x', 'param': 'arg%d',
+        'types': ['int64_t', 'int32_t', 'uint64_t', 'uint8_t', 'char'],
+    },
+    'ghidra': {
+        'header': 'decompile_ghidra.h', 'defines': True, 'return': 'ulong',
+        'function': 'FUN_%08x', 'local': 'uVar%d', 'param': 'param_%d',
+        'types': ['undefined', 'byte', 'uint', 'ulong', 'long', 'char'],
+    },
+    'ida': {
+        'header': 'decompile_idapro.h', 'defines': True, 'return': '__int64',
+        'function': 'sub_%X', 'local': 'v%d', 'param': 'a%d',
+        'types': ['__int64', '_DWORD', '_QWORD', '_BYTE', 'unsigned int', 'char'],
+    },
+    'radare2': {
+        'header': 'decompile_radare2.h', 'defines': False, 'return': 'int32_t',
+        'function': 'fcn_%08x', 'local': 'var_%xh', 'param': 'arg%d',
+        'types': ['int64_t', 'uint32_t', 'int32_t', 'uint', 'char'],
+    },
+    'retdec': {
+        'header': 'decompile_retdec.h', 'defines': False, 'return': 'int64_t',
+        'function': 'function_%x', 'local': 'v%d', 'param': 'a%d',
+        'types': ['int64_t', 'int32_t', 'uint64_t', 'char', 'float64_t'],
+    },
+}
+
+DEFINES = ['#define __int64 long long', '#define __int32 int', '#define __int16 short', '#define __int8 char']
+
+LIBC = ['memset', 'free', 'strcmp', 'strlen', 'abort']
+OPERATORS = ['+', '-', '*', '&', '|', '^', '<<', '>>']
+COMPARISONS = ['==', '!=', '<', '>', '<=', '>=']
+
+# marks a dataset as generated, so that it can be overwritten
+MARKER = '.benchmark'
+
+def typename(name, pointer=False):
+    t = c_ast.TypeDecl(None, [], None, c_ast.IdentifierType(name.split()))
+    return c_ast.Typename(None, [], None, c_ast.PtrDecl([], t) if pointer else t)
+
+def declaration(name, type_name):
+    return c_ast.Decl(name, [], [], [], [], c_ast.TypeDecl(name, [], None, c_ast.IdentifierType(type_name.split())),
+                      None, None)
+
+def count_nodes(node):
+    count = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(child for (_, child) in node.children())
+    return count
+
+class Function(object):
+    """ Random body of a function in the style of a decompiler. Statements
+        nest up to depth levels, any of them being a goto with probability
+        gotos, and any operand being cast with probability casts.
+    """
+    def __init__(self, rng, style, name, callees, depth, statements, gotos, casts):
+        self.rng = rng
+        self.style = style
+        self.name = name
+        self.callees = callees
+        self.depth = depth
+        self.statements = statements
+        self.gotos = gotos
+        self.casts = casts
+        self.labels = []
+
+        local = style['local']
+        scale = 8 if '%x' in local else 1
+        self.locals = [local % (scale * (i + 1)) for i in range(rng.randint(2, 2 + 2 * statements))]
+        self.params = [style['param'] % (i + 1) for i in range(rng.randint(0, 3))]
+
+    def operand(self, level):
+        rng = self.rng
+        if level == 0 or rng.random() < 0.4:
+            if rng.random() < 0.3:
+                e = c_ast.Constant('int', hex(rng.randint(0, 0xffff)))
+            else:
+                e = c_ast.ID(rng.choice(self.locals + self.params))
+        else:
+            e = c_ast.BinaryOp(rng.choice(OPERATORS), self.operand(level - 1), self.operand(level - 1))
+        if rng.random() < self.casts:
+            # a third of the casts are to pointers read through, like *(_DWORD *)(a1 + 8)
+            pointer = rng.random() < 1 / 3
+            e = c_ast.Cast(typename(rng.choice(self.style['types']), pointer), e)
+            if pointer:
+                e = c_ast.UnaryOp('*', e)
+        return e
+
+    def condition(self):
+        return c_ast.BinaryOp(self.rng.choice(COMPARISONS), self.operand(1), self.operand(1))
+
+    def call(self):
+        rng = self.rng
+        name = rng.choice(LIBC) if rng.random() < 0.2 else rng.choice(self.callees)
+        args = [self.operand(1) for _ in range(rng.randint(0, 3))]
+        return c_ast.FuncCall(c_ast.ID(name), c_ast.ExprList(args) if args else None)
+
+    def simple(self):
+        rng = self.rng
+        if rng.random() < self.gotos:
+            label = 'label_%d' % len(self.labels)
+            self.labels.append(label)
+            return c_ast.Goto(label)
+        if rng.random() < 0.2:
+            return self.call()
+        value = self.call() if rng.random() < 0.1 else self.operand(2)
+        return c_ast.Assignment('=', c_ast.ID(rng.choice(self.locals)), value)
+
+    def block(self, level):
+        rng = self.rng
+        items = []
+        for _ in range(rng.randint(1, self.statements)):
+            if level < self.depth and rng.random() < 0.4:
+                items.append(self.compound(level + 1))
+            else:
+                items.append(self.simple())
+        return c_ast.Compound(items)
+
+    def compound(self, level):
+        rng = self.rng
+        kind = rng.choice(['if', 'if', 'while', 'for', 'dowhile', 'switch'])
+        if kind == 'if':
+            iffalse = self.block(level) if rng.random() < 0.3 else None
+            return c_ast.If(self.condition(), self.block(level), iffalse)
+        if kind == 'while':
+            return c_ast.While(self.condition(), self.block(level))
+        if kind == 'dowhile':
+            return c_ast.DoWhile(self.condition(), self.block(level))
+        if kind == 'for':
+            i = rng.choice(self.locals)
+            return c_ast.For(c_ast.Assignment('=', c_ast.ID(i), c_ast.Constant('int', '0')),
+                             c_ast.BinaryOp('<', c_ast.ID(i), self.operand(0)),
+                             c_ast.UnaryOp('p++', c_ast.ID(i)), self.block(level))
+        cases = [c_ast.Case(c_ast.Constant('int', str(k)), self.block(level).block_items + [c_ast.Break()])
+                 for k in range(rng.randint(1, 3))]
+        cases.append(c_ast.Default(self.block(level).block_items))
+        return c_ast.Switch(self.operand(1), c_ast.Compound(cases))
+
+    def generate(self):
+        """ Returns the FuncDef node
+        """
+        rng = self.rng
+        style = self.style
+        body = self.block(0).block_items
+        # every goto jumps to a label somewhere in the outermost block
+        for label in self.labels:
+            k = rng.randint(0, len(body))
+            body.insert(k, c_ast.Label(label, c_ast.Assignment('=', c_ast.ID(rng.choice(self.locals)), self.operand(1))))
+        body.append(c_ast.Return(c_ast.ID(self.locals[0])))
+        decls = [declaration(x, rng.choice(style['types'])) for x in self.locals]
+
+        if self.params:
+            params = [declaration(x, rng.choice(style['types'])) for x in self.params]
+        else:
+            params = [typename('void')]
+        decl = c_ast.FuncDecl(c_ast.ParamList(params),
+                              c_ast.TypeDecl(self.name, [], None, c_ast.IdentifierType(style['return'].split())))
+        return c_ast.FuncDef(c_ast.Decl(self.name, [], [], [], [], decl, None, None), None,
+                             c_ast.Compound(decls + body))
+
+def generate(experiment, targets, binaries, functions, depth, statements, gotos, casts, seed):
+    """ Write a synthetic dataset of binaries decompiled by every target, in
+        the layout of dataset/test. The functions of a binary sit at the same
+        addresses for each target, their bodies differ. Returns the number of
+        AST nodes of the functions of each target.
+    """
+    root = os.path.join('dataset', experiment)
+    if os.path.isdir(root):
+        if not os.path.exists(os.path.join(root, MARKER)):
+            raise ValueError('%s was not generated by the benchmark' % root)
+        shutil.rmtree(root)
+    os.makedirs(root)
+    open(os.path.join(root, MARKER), 'w').close()
+
+    generator = c_generator.CGenerator()
+    nodes = dict.fromkeys(targets, 0)
+    for b in range(binaries):
+        binary = 'synthetic_%d.elf' % b
+        rng = random.Random('%d:%s' % (seed, binary))
+        addresses = []
+        address = 0x401000
+        for _ in range(functions):
+            addresses.append(address)
+            address += rng.randint(0x10, 0x400)
+        addresses.append(address)
+
+        for target in targets:
+            style = STYLES[target]
+            rng = random.Random('%d:%s:%s' % (seed, binary, target))
+            names = [style['function'] % a for a in addresses[:-1]]
+            (texts, infos) = ([], [])
+            for (i, name) in enumerate(names):
+                func = Function(rng, style, name, names, depth, statements, gotos, casts).generate()
+                nodes[target] += count_nodes(func)
+                text = generator.visit(func)
+                texts.append(text)
+                start = '%x' % addresses[i] if target == 'retdec' else '0x%x' % addresses[i]
+                end = '%x' % addresses[i + 1] if target == 'retdec' else '0x%x' % addresses[i + 1]
+                infos.append({'funcName': name, 'funcStartAddr': start, 'funcEndAddr': end, 'decompiledFuncCode': text})
+
+            for folder in ['syntax_correction', 'json']:
+                os.makedirs(os.path.join(root, target, folder), exist_ok=True)
+            header = ['#include "%s"' % style['header']] + (DEFINES if style['defines'] else [])
+            with open(os.path.join(root, target, 'syntax_correction', binary + '.c'), 'w') as f:
+                f.write('\n'.join(header) + '\n' + '\n'.join(texts))
+            with open(os.path.join(root, target, 'json', binary + '.json'), 'w') as f:
+                json.dump({'funcInfo': infos}, f, indent=4)
+    return nodes
+
+def run(name, args, cwd, report):
+    """ Run a script of src/ with its stages recorded to report. Returns the
+        wall time and the peak RSS in MB of its largest process.
+    """
+    env = dict(os.environ, R2I_TIMING=report)
+    if os.path.exists(report):
+        os.remove(report)
+    wall = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(sys.path[0], name)] + args, cwd=cwd, env=env,
+                   stdout=subprocess.DEVNULL, check=True)
+    wall = time.perf_counter() - wall
+    rss = pd.read_json(report, lines=True)['rss'].max() if os.path.exists(report) else None
+    return (wall, None if pd.isna(rss) else float(rss))
+
+def compare(results, baseline):
+    rows = []
+    for step in ['extractor', 'aggregator', 'evaluator']:
+        for metric in ['functions_per_sec', 'nodes_per_sec', 'peak_rss']:
+            (now, then) = (results[step][metric], baseline.get(step, {}).get(metric))
+            ratio = now / then if now is not None and then else None
+            rows.append({'step': step, 'metric': metric, 'baseline': then, 'current': now, 'ratio': ratio})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--experiment', default='benchmark',
+                            help='name of the generated dataset and of its extract/ and eval/ folders')
+    parser.add_argument('-t', '--targets', nargs='+', default=list(STYLES), choices=list(STYLES),
+                            help='decompilers whose style is generated')
+    parser.add_argument('-b', '--binaries', type=int, default=4, help='number of binaries')
+    parser.add_argument('-n', '--functions', type=int, default=250, help='number of functions of each binary')
+    parser.add_argument('--depth', type=int, default=3, help='deepest nesting of statements')
+    parser.add_argument('--statements', type=int, default=4, help='most statements of a block')
+    parser.add_argument('--gotos', type=float, default=0.05, help='probability of a statement being a goto')
+    parser.add_argument('--casts', type=float, default=0.2, help='probability of an operand being cast')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-f', '--format', choices=['csv', 'parquet'], default='csv',
+                            help='format of the feature scores passed between the steps')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                            help='number of worker processes of the extractor and the evaluator')
+    parser.add_argument('-w', '--weight', default='paper', help='weight for evaluation')
+    parser.add_argument('--baseline', help='results of an earlier benchmark to compare with')
+    args = parser.parse_args()
+    if len(args.targets) < 2:
+        print('[-] The evaluator needs at least two targets', file=sys.stderr)
+        sys.exit(1)
+    # read before the results of this run can overwrite it
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    os.chdir(os.path.dirname(sys.path[0]))
+
+    corpus = {k: getattr(args, k) for k in ['binaries', 'functions', 'depth', 'statements', 'gotos', 'casts', 'seed']}
+    corpus['targets'] = args.targets
+    wall = time.perf_counter()
+    try:
+        nodes = generate(args.experiment, args.targets, args.binaries, args.functions, args.depth, args.statements,
+                         args.gotos, args.casts, args.seed)
+    except ValueError as e:
+        print('[-] %s' % e, file=sys.stderr)
+        sys.exit(1)
+    functions = args.binaries * args.functions * len(args.targets)
+    corpus.update(total_functions=functions, nodes=sum(nodes.values()))
+    print('[+] Generated %d functions of %d AST nodes in %.2fs' % (functions, corpus['nodes'], time.perf_counter() - wall))
+
+    eval_dir = os.path.join('eval', args.experiment)
+    os.makedirs(os.path.join(eval_dir, 'bin'), exist_ok=True)
+    # the steps of run.sh, but without the caches so that every run parses again
+    steps = [
+        ('extractor', 'extractor.py', ['-s', '--prelude', '-f', args.format, '-j', str(args.jobs),
+                                       '-b', args.experiment] + args.targets, '.'),
+        ('aggregator', 'aggregator.py', [args.experiment, '-s', '-f', args.format, '-t'] + args.targets, 'extract'),
+        ('evaluator', 'evaluator.py', ['-f', args.format, '-j', str(args.jobs), '-w', args.weight,
+                                       '-t'] + args.targets, eval_dir),
+    ]
+    results = {'corpus': corpus}
+    for (step, script, script_args, cwd) in steps:
+        report = os.path.abspath(os.path.join(eval_dir, step + '.jsonl'))
+        (wall, rss) = run(script, script_args, cwd, report)
+        results[step] = {'wall': wall, 'functions_per_sec': functions / wall,
+                         'nodes_per_sec': corpus['nodes'] / wall, 'peak_rss': rss}
+        print('[+] %s: %.2fs, %.0f functions/s, %.0f nodes/s, peak RSS %s MB'
+              % (step, wall, functions / wall, corpus['nodes'] / wall, 'n/a' if rss is None else '%.1f' % rss),
+              flush=True)
+    shutil.rmtree(os.path.join('extract', args.experiment))
+    shutil.rmtree(os.path.join(eval_dir, 'bin'))
+
+    target_name = os.path.join(eval_dir, 'benchmark.json')
+    with open(target_name, 'w') as f:
+        json.dump(results, f, indent=4)
+    print('[+] Successfully saved the benchmark results: %s' % target_name)
+
+    if baseline is not None:
+        if baseline.get('corpus') != corpus:
+            print('[-] The baseline was taken on another corpus: %s' % baseline.get('corpus'), file=sys.stderr)
+        print(compare(results, baseline).to_string(index=False))
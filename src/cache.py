@@ -0,0 +1,153 @@
+import os
+import re
+import sys
+import zlib
+import shutil
+import pickle
+import hashlib
+import tempfile
+import functools
+import compileall
+import importlib.util
+import pycparser
+from pycparser import CParser
+
+CACHE_DIR = os.environ.get('R2I_CACHE',
+                os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.r2i-cache'))
+
+GRAMMAR_SOURCES = ['c_lexer.py', 'c_parser.py', 'plyparser.py', 'ply/lex.py', 'ply/yacc.py']
+LEXTAB = 'r2i_lextab'
+YACCTAB = 'r2i_yacctab'
+
+# Parsed preludes of this process: (top-level nodes, file scope) by prelude hash
+PRELUDES = {}
+
+LINE_MARKER = re.compile(r'^# \d+ "([^"]*)"((?: \d+)*)[ \t]*$', re.MULTILINE)
+
+@functools.lru_cache(maxsize=None)
+def grammar_hash():
+    h = hashlib.sha1(pycparser.__version__.encode())
+    for source in GRAMMAR_SOURCES:
+        with open(os.path.join(os.path.dirname(pycparser.__file__), source), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def build_tables():
+    target_dir = os.path.join(CACHE_DIR, 'tables', grammar_hash())
+    if os.path.isdir(target_dir):
+        return target_dir
+
+    os.makedirs(os.path.dirname(target_dir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(target_dir))
+    CParser(lextab=LEXTAB, yacctab=YACCTAB, taboutputdir=tmp_dir)
+    compileall.compile_dir(tmp_dir, quiet=1)
+    try:
+        os.rename(tmp_dir, target_dir)
+    except OSError:
+        # another process has published the same tables in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return target_dir
+
+def make_parser():
+    table_dir = build_tables()
+    return CParser(lextab=_load_table(LEXTAB, table_dir),
+                   yacctab=_load_table(YACCTAB, table_dir),
+                   taboutputdir=table_dir)
+
+def _load_table(name, table_dir):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(table_dir, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def parse_cached(parse, text, filename):
+    key = hashlib.sha1(grammar_hash().encode())
+    key.update(text.encode())
+    key = key.hexdigest()
+    target_name = os.path.join(CACHE_DIR, 'ast', key[:2], key + '.pickle.z')
+
+    ast = _load(target_name)
+    if ast is None:
+        ast = parse(text, filename)
+        _store(target_name, ast)
+    return ast
+
+def parse_with_prelude(parser, text, filename):
+    (prelude, rest) = split_prelude(text, filename)
+    if prelude is None:
+        return parser.parse(text, filename)
+
+    # the same header expands to the same prelude in every file but the name
+    prelude = prelude.replace('"%s"' % filename, '""')
+    key = hashlib.sha1(grammar_hash().encode())
+    key.update(prelude.encode())
+    key = key.hexdigest()
+    if key not in PRELUDES:
+        target_name = os.path.join(CACHE_DIR, 'prelude', key + '.pickle.z')
+        snapshot = _load(target_name)
+        if snapshot is None:
+            ast = parser.parse(prelude, filename)
+            snapshot = (ast.ext, parser._scope_stack[0])
+            _store(target_name, snapshot)
+        PRELUDES[key] = snapshot
+
+    (ext, scope) = PRELUDES[key]
+    ast = parser.parse(rest, filename, scope=scope)
+    ast.ext[0:0] = ext
+    return ast
+
+def split_prelude(text, filename):
+    """ Split preprocessed text where the first #include of the file itself
+        returns to the file, using the line markers of the preprocessor.
+    """
+    depth = 0
+    current = None
+    included = False
+    for m in LINE_MARKER.finditer(text):
+        (name, flags) = (m.group(1), m.group(2).split())
+        if flags[:1] == ['1']:
+            if depth == 0 and current == filename:
+                included = True
+            depth += 1
+        elif flags[:1] == ['2']:
+            depth -= 1
+            if depth == 0 and included and name == filename:
+                return (text[:m.start()], text[m.start():])
+        if depth == 0:
+            current = name
+    return (None, text)
+
+def load_features(source_name):
+    features = _load(_features_path(source_name))
+    return {} if features is None else features
+
+def store_features(source_name, features):
+    _store(_features_path(source_name), features)
+
+def _features_path(source_name):
+    key = hashlib.sha1(os.path.abspath(source_name).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, 'features', key + '.pickle.z')
+
+def _load(target_name):
+    try:
+        with open(target_name, 'rb') as f:
+            return pickle.loads(zlib.decompress(f.read()))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print('[-] Ignored broken cache entry %s: %s' % (target_name, e), file=sys.stderr)
+        return None
+
+def _store(target_name, obj):
+    try:
+        data = zlib.compress(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+    except RecursionError:
+        return
+    os.makedirs(os.path.dirname(target_name), exist_ok=True)
+    (fd, tmp_name) = tempfile.mkstemp(dir=os.path.dirname(target_name))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_name, target_name)
+
+if __name__ == '__main__':
+    print('[+] Parser tables cached in %s' % build_tables())
@@ -0,0 +1,51 @@
+import bisect
+
+# sorts after any character of a function name
+LAST_CHAR = '\U0010ffff'
+
+class Catalog(object):
+    """ funcInfo entries of a decompiled file. pop() finds the first entry in
+        file order whose name starts with a prefix, like a scan over the list,
+        but in logarithmic time, and takes it out of the catalog.
+    """
+    def __init__(self, infos):
+        self.infos = infos
+        order = sorted(range(len(infos)), key=lambda i: infos[i]['funcName'])
+        self.names = [infos[i]['funcName'] for i in order]
+        self.rank = [0] * len(infos)
+        for (rank, i) in enumerate(order):
+            self.rank[i] = rank
+
+        # segment tree over the sorted names holding the smallest file position
+        # left in each range, len(infos) once all of them were popped
+        self.size = 1
+        while self.size < len(infos):
+            self.size *= 2
+        self.tree = [len(infos)] * (2 * self.size)
+        self.tree[self.size:self.size + len(order)] = order
+        for k in range(self.size - 1, 0, -1):
+            self.tree[k] = min(self.tree[2 * k], self.tree[2 * k + 1])
+
+    def pop(self, prefix):
+        lo = bisect.bisect_left(self.names, prefix)
+        hi = bisect.bisect_left(self.names, prefix + LAST_CHAR, lo)
+
+        first = len(self.infos)
+        (lo, hi) = (lo + self.size, hi + self.size)
+        while lo < hi:
+            if lo & 1:
+                first = min(first, self.tree[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                first = min(first, self.tree[hi])
+            (lo, hi) = (lo // 2, hi // 2)
+        if first == len(self.infos):
+            return None
+
+        k = self.rank[first] + self.size
+        self.tree[k] = len(self.infos)
+        while k > 1:
+            k //= 2
+            self.tree[k] = min(self.tree[2 * k], self.tree[2 * k + 1])
+        return self.infos[first]
@@ -4,42 +4,81 @@ import numpy as np
 import pandas as pd
 import os
 import math
-from copy import deepcopy
+import json
+import warnings
+import shutil
+import multiprocessing
 
 from extractor import FEATURES_HDR
+from join import join
+from timing import Stages
 FEATURES_GROW = ['ref_structured', 'strcmp', 'fix',
                  'prop_branch_case', 'prop_branch_ternary',
                  'prop_loop_for', 'prop_loop_while']
 FEATURES_WEIGHT = {}
+C_COL_NAMES = ['decompiler', 'binary', 'address'] + sorted(FEATURES_HDR[1:])
+INDEX = ['binary', 'address', 'decompiler']
+# functions scored and written at a time
+CHUNK = 10000
+# weight vectors of a sweep scored at a time
+SWEEP_BLOCK = 64
 
 class R2I():
-    def __init__(self, targets):
+    def __init__(self, targets, jobs=1):
         self.targets = targets
+        self.jobs = jobs
         self.r2 = targets.index('radare2') if 'radare2' in targets else None
-        self.features = dict()
+        self.features = None
+        self.matrix = None
+        self.dtypes = None
         self.W = []     
-        self.C = dict() 
+        self.C = None
         self.B = dict() 
-        self.R = []     
+        self.R = None
+        self.dropped = None
+        self.stages = Stages()
 
-    def collect_features(self, w):
-        if not os.path.isfile('aggregated.csv'):
-            print("[-] Not found: aggregated.csv")
+    def collect_features(self, w, fmt='csv', matrix=False):
+        target_name = 'aggregated.' + ('npy' if matrix else fmt)
+        if not os.path.isfile(target_name):
+            print("[-] Not found: %s" % target_name)
             sys.exit()
-        data = pd.read_csv('aggregated.csv', header=0, delimiter=',')
-        
-        for dv in data.values:
-            func = (dv[1], dv[2])
-            if func not in self.features:
-                self.features[func] = {}
-            if dv[1] not in self.B:
-                self.B[dv[1]] = []
-            self.features[func].update({dv[0]: list(dv[:-1])})
-        self.C = deepcopy(self.features)
+        if matrix:
+            # features stay on disk, one contiguous column each, next to their index
+            self.matrix = np.load(target_name, mmap_mode='r')
+            with open('aggregated.json', 'r') as f:
+                integer = json.load(f)['integer']
+            self.dtypes = pd.Series({feature: int if feature in integer else float for feature in C_COL_NAMES[3:]})
+            data = pd.read_csv('aggregated.idx.csv', header=0, delimiter=',')
+        else:
+            if fmt == 'parquet':
+                data = pd.read_parquet(target_name)
+            else:
+                # the last column is left empty by the aggregator
+                data = pd.read_csv(target_name, header=0, delimiter=',').iloc[:, :-1]
+            # columns are taken by position
+            data = data.set_axis(C_COL_NAMES, axis=1)
+            self.matrix = data[C_COL_NAMES[3:]].to_numpy(dtype=float)
+            self.dtypes = data[C_COL_NAMES[3:]].dtypes
+            data = data[C_COL_NAMES[:3]]
+        data = data.set_axis(C_COL_NAMES[:3], axis=1).assign(_row=np.arange(len(data)))
+
+        # functions and their decompilers in order of appearance, a decompiler
+        # listed twice for a function keeps its place with the values of its last row
+        rows = data.groupby(INDEX, sort=False, dropna=False)
+        funcs = data.groupby(INDEX[:2], sort=False, dropna=False)
+        data = data.assign(_func=funcs.ngroup(), _first=rows.ngroup())
+        data = data[rows.cumcount(ascending=False) == 0].sort_values(['_func', '_first'], kind='stable')
+
+        self.B = dict.fromkeys(data['binary'].unique())
+        # rows of self.matrix by (binary, address, decompiler)
+        self.features = data.set_index(INDEX)['_row']
 
         for feature in FEATURES_HDR[1:]:
             FEATURES_WEIGHT[feature] = 0
         self.W = pd.Series(FEATURES_WEIGHT).sort_index()
+        if w is None:
+            return
         
         weight = pd.read_csv(f'{sys.path[0]}/weight.csv', header=0, delimiter=',')
         if w not in weight.columns[1:]:
@@ -49,95 +88,242 @@ class R2I():
         for dv in weight.values:
             self.W[dv[0]] = dv[w]
 
-    def evaluate(self, is_debug=False):
-        C_col_names = ['decompiler', 'binary', 'address'] + sorted(FEATURES_HDR[1:])
-        f = open('r2i.csv', 'w')
-        f.write(','.join(C_col_names)+',r2i\n')
-
-        for func in sorted(self.features.keys()):
-            fully_identified = len(self.features[func].keys()) == len(self.targets)
-            if fully_identified:
-                self.C[func] = pd.DataFrame(self.C[func].values(), columns=C_col_names)
-            else:
-                del self.C[func]
+    def transform(self, X, features):
+        # the part of the score that does not depend on the weights: X holds
+        # the given features of many functions (function x decompiler x
+        # feature), mapped to [0, 1] here, and which of them are kept for
+        # each function
+        with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+            warnings.simplefilter('ignore', RuntimeWarning)
+            f_max, f_min = np.nanmax(X, axis=1), np.nanmin(X, axis=1)
+        kept = ~(f_max - f_min == 0)
+        for feature in ['branch_case', 'branch_if', 'branch_ternary', 'loop_dowhile', 'loop_for', 'loop_while']:
+            if feature in features:
+                kept[:, features.index(feature)] = False
+
+        if self.r2 and 'local' in features:
+            X = X.copy()
+            X[:, self.r2, features.index('local')] = f_max[:, features.index('local')]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            diff = X - np.nanmin(X, axis=1, keepdims=True)
+
+        # the transform of the few distinct values keeps the results of math
+        values, inverse = np.unique(diff, return_inverse=True)
+        values = np.array([math.exp(-1 * math.log(x + 1)) for x in values])
+        c = values[inverse].reshape(diff.shape)
+        grow = [k for (k, feature) in enumerate(features) if feature in FEATURES_GROW]
+        c[:, :, grow] = 1 - c[:, :, grow]
+        return (c, kept)
+
+    def score(self, X, features):
+        # all functions of X are scored at once, features left out must have
+        # no weight
+        (c, kept) = self.transform(X, features)
+
+        # weights of the features left for each function, summed in the same order
+        w = self.W[features].to_numpy(dtype=float)
+        w_sum = 0
+        for k in range(len(features)):
+            w_sum = w_sum + np.where(kept[:, k], w[k], 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            c = c * (w / w_sum[:, None])[:, None, :]
+            c[~np.broadcast_to(kept[:, None, :], c.shape) | np.isnan(c)] = 0
+
+        r2i = np.zeros(X.shape[:2])
+        for k in range(len(features)):
+            r2i += c[:, :, k]
+        return r2i
+
+    def rank(self, S, decompilers):
+        # min method ranks of the scores of each function in descending order,
+        # one column per target
+        ranks = 1 + (S[:, None, :] > S[:, :, None]).sum(axis=2)
+        pos = pd.Index(self.targets).get_indexer(decompilers.ravel()).reshape(ranks.shape)
+        R = np.zeros((len(ranks), len(self.targets)), dtype=int)
+        (f, t) = np.nonzero(pos >= 0)
+        R[f, pos[f, t]] = ranks[f, t]
+        return pd.DataFrame(R, columns=self.targets)
+
+    def shard(self, binaries):
+        # bounds of ranges of functions scored apart, never between two rows
+        # saved to the same bin/ file, one range for each job at least
+        names = binaries.map(lambda bin: bin.split('_')[-1]).to_numpy()
+        F = len(names)
+        if F == 0:
+            return []
+        (_, group) = np.unique(names, return_inverse=True)
+        last = np.zeros(group.max() + 1, dtype=int)
+        last[group] = np.arange(F)
+        reach = np.maximum.accumulate(last[group])
+        cuts = np.flatnonzero(reach[:-1] == np.arange(F - 1)) + 1
+
+        n = max(self.jobs, -(-F // CHUNK))
+        bounds = cuts[np.minimum(np.searchsorted(cuts, np.arange(1, n) * F / n), len(cuts) - 1)] if len(cuts) else []
+        bounds = np.unique(np.concatenate([[0], bounds, [F]])).astype(int)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def evaluate_shard(self, lo, hi):
+        # scores the functions lo to hi, writes their rows of r2i.csv to a
+        # part of its own and the bin/ files of their binaries
+        T = len(self.targets)
+        stages = Stages(shard=int(lo))
+        rows = self.C.to_numpy()[lo*T:hi*T]
+        C = self.C.index[lo*T:hi*T].to_frame(index=False)[C_COL_NAMES[:3]]
+        features = C_COL_NAMES[3:]
+        # only the columns with a weight are read to score
+        weighted = [k for (k, feature) in enumerate(features) if self.W[feature] != 0]
+        S = np.zeros((len(rows) // T, T))
+        with stages.stage('evaluate.score'):
+            for i in range(0, len(rows), CHUNK*T):
+                X = self.matrix[rows[i:i+CHUNK*T, None], weighted]
+                S[i//T:(i+len(X))//T] = self.score(X.reshape(len(X)//T, T, len(weighted)), [features[k] for k in weighted])
+
+        C['r2i'] = S.ravel()
+        with stages.stage('evaluate.write'), open('r2i.csv.%d' % lo, 'w') as f:
+            for i in range(0, len(rows), CHUNK*T):
+                c = pd.DataFrame(self.matrix[rows[i:i+CHUNK*T]], columns=features).astype(self.dtypes)
+                c = pd.concat([C.iloc[i:i+CHUNK*T, :3].reset_index(drop=True), c, C.iloc[i:i+CHUNK*T, 3:].reset_index(drop=True)], axis=1)
+                c.to_csv(f, index=False, header=False)
+
+        with stages.stage('evaluate.bin'):
+            indices = dict(tuple(C.groupby('binary', sort=False, dropna=False)))
+            for bin in self.B.keys():
+                if bin not in indices:
+                    continue
+                bin_path = os.sep.join(['bin', bin.split('_')[-1] + '.csv'])
+                with open(bin_path, 'w') as f:
+                    indices[bin].to_csv(f, index=False)
+        stages.report()
+        return S
+
+    def sieve(self):
+        with self.stages.stage('evaluate.sieve'):
+            (fully_identified, self.dropped) = join(self.features.index.to_frame(index=False), self.targets, self.jobs)
+        self.C = self.features[fully_identified]
         
         print("[+] Successfully sieved common functions...")
+        print("[+] Functions left out for missing in another target: %s" %
+              ', '.join('%s %d' % (target, n) for (target, n) in self.dropped.items()))
 
-        for func in self.C.keys():
-            c = self.C[func].copy().reset_index(drop=True)
-            indices = c.filter(['decompiler', 'binary', 'address'], axis=1)
-            c = c.drop(['decompiler', 'binary', 'address'], axis=1)
-            w = self.W.copy()
-            
-            for feature in FEATURES_HDR[1:]:
-                f_max, f_min = c[feature].max(), c[feature].min()
-                    
-                if f_max - f_min == 0 or feature in ['branch_case', 'branch_if', 'branch_ternary', 'loop_dowhile', 'loop_for', 'loop_while']:
-                    c = c.drop(feature, axis=1)
-                    w = w.drop(feature)
-                    continue
-                
-                if feature == 'local' and self.r2:
-                    c.at[self.r2, feature] = f_max
-
-                diff = c[feature] - c[feature].min()
-                c[feature] = diff.apply(lambda x: math.exp(-1 * math.log(x + 1)))
-                c[feature] = 1 - c[feature] if feature in FEATURES_GROW \
-                            else c[feature]
-
-            c = c.mul(w / sum(w))
-
-            if is_debug:
-                print("\n[+] @%s in %s" % indices[2], indices[1])
-
-            r2i = []
-            for idx in range(len(indices)):
-                decompiler = indices['decompiler'][idx]
-                fa = indices['address'][idx]
-                r2i.append(c.sum(axis='columns')[idx])
-                if is_debug:
-                    print("\tr2i(%s): %.4f" % (decompiler, r2i[idx]))
-            r2i = pd.DataFrame({'r2i': r2i})
-
-            func_ranks = {}
-            for decompiler in self.targets:
-                func_ranks[decompiler] = 0
-            scores = list(r2i['r2i'])
-            sorted_scores = sorted(scores, reverse=True)
-            for rank, score in enumerate(sorted_scores):
-                rank = sorted_scores[:rank+1].index(score)
-                found = scores.index(score)
-                decompiler = indices['decompiler'][found]
-                scores[found] = None
-                func_ranks[decompiler] = rank+1
-            self.R.append(list(func) + list(func_ranks.values()))
-
-            indices['r2i'] = r2i['r2i']
-            self.B[func[0]].append(indices)
-            
-            c = self.C[func].copy()
-            c['r2i'] = r2i['r2i']
-            c.to_csv(f, index=False, header=False)
+    def sweep(self, W):
+        # mean r2i and rank of each target over the common functions under
+        # every weight vector (a column of W by feature). The features are
+        # transformed once, each block of vectors then takes a product for
+        # the weighted sums and one for the weights left to each function.
+        self.sieve()
+        T = len(self.targets)
+        features = C_COL_NAMES[3:]
+        W = W.reindex(features, fill_value=0).fillna(0)
+        rows = self.C.to_numpy()
+        decompilers = self.C.index.get_level_values('decompiler').to_numpy()
+        (r2i, rank) = (np.zeros((T, W.shape[1])), np.zeros((T, W.shape[1])))
+        for i in range(0, len(rows), CHUNK*T):
+            X = self.matrix[rows[i:i+CHUNK*T]]
+            (c, kept) = self.transform(X.reshape(len(X)//T, T, len(features)), features)
+            c[~np.broadcast_to(kept[:, None, :], c.shape) | np.isnan(c)] = 0
+            pos = pd.Index(self.targets).get_indexer(decompilers[i:i+CHUNK*T]).reshape(c.shape[:2])
+            (f, t) = np.nonzero(pos >= 0)
+
+            for v in range(0, W.shape[1], SWEEP_BLOCK):
+                w = W.iloc[:, v:v+SWEEP_BLOCK].to_numpy(dtype=float)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    S = (c.reshape(-1, len(features)) @ w).reshape(c.shape[:2] + (w.shape[1],)) / (kept @ w)[:, None, :]
+                S[~np.isfinite(S)] = 0
+                R = 1 + (S[:, None, :, :] > S[:, :, None, :]).sum(axis=2)
+                np.add.at(r2i[:, v:v+SWEEP_BLOCK], pos[f, t], S[f, t])
+                np.add.at(rank[:, v:v+SWEEP_BLOCK], pos[f, t], R[f, t])
+
+        functions = max(len(rows) // T, 1)
+        return pd.concat([pd.DataFrame(r2i.T / functions, columns=['r2i_' + target for target in self.targets]),
+                          pd.DataFrame(rank.T / functions, columns=['rank_' + target for target in self.targets])],
+                         axis=1).set_axis(W.columns, axis=0).rename_axis('weight').reset_index()
+
+    def evaluate(self, is_debug=False):
+        self.sieve()
+        T = len(self.targets)
+        C = self.C.index.to_frame(index=False)[C_COL_NAMES[:3]]
+        shards = self.shard(C['binary'][::T])
+        if self.jobs > 1:
+            with multiprocessing.Pool(self.jobs, initializer=_init_worker, initargs=(self,)) as pool:
+                S = pool.starmap(_evaluate_task, shards)
+        else:
+            S = [self.evaluate_shard(lo, hi) for (lo, hi) in shards]
+        S = np.concatenate(S) if S else np.zeros((0, T))
+
+        funcs = self.C.index[::T].droplevel('decompiler')
+        with self.stages.stage('evaluate.rank'):
+            R = self.rank(S, C['decompiler'].to_numpy().reshape(S.shape))
+            self.R = pd.concat([funcs.to_frame(index=False), R], axis=1)
+
+        if is_debug:
+            for (n, func) in enumerate(funcs):
+                print("\n[+] @%s in %s" % (func[1], func[0]))
+                for (decompiler, r2i) in zip(C['decompiler'][n*T:(n+1)*T], S[n]):
+                    print("\tr2i(%s): %.4f" % (decompiler, r2i))
+
+        with self.stages.stage('evaluate.merge'), open('r2i.csv', 'w') as f:
+            f.write(','.join(C_COL_NAMES)+',r2i\n')
+            for (lo, hi) in shards:
+                with open('r2i.csv.%d' % lo, 'r') as part:
+                    shutil.copyfileobj(part, f)
+                os.remove('r2i.csv.%d' % lo)
         print("[+] Successfully saved feature & r2i values: r2i.csv")
-        f.close()
-        
-        for bin in self.B.keys():
-            if not self.B[bin]:
-                continue
-            bin_path = os.sep.join(['bin', bin.split('_')[-1] + '.csv'])
-            with open(bin_path, 'w') as f:
-                pd.concat(self.B[bin], axis=0).to_csv(f, index=False)
         print("[+] Successfully saved evaluation on each binary")
 
+_r2i = None
+
+def _init_worker(r2i):
+    global _r2i
+    _r2i = r2i
+
+def _evaluate_task(lo, hi):
+    return _r2i.evaluate_shard(lo, hi)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-t', '--targets', nargs='+', required=True,
                             help='specify targets to relatively evaluate')
     parser.add_argument('-w', '--weight', action='store', help='specify weight for evaluation')
+    parser.add_argument('-r', '--ranks', action='store_true', default=False,
+                            help='save the rank of each target for every common function')
+    parser.add_argument('-f', '--format', choices=['csv', 'parquet'], default='csv',
+                            help='format of the aggregated feature scores')
+    parser.add_argument('-m', '--matrix', action='store_true', default=False,
+                            help='read the aggregated feature scores from a memory-mapped matrix')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='number of worker processes joining and scoring the functions of the targets')
+    parser.add_argument('-s', '--sweep', type=int, nargs='?', const=0, metavar='N',
+                            help='instead of evaluating, save the mean r2i and rank of each target under every weight '
+                                 'of weight.csv, or under N random weights, to sweep.csv')
     args = parser.parse_args()
+    if args.weight is None and args.sweep is None:
+        print('[-] Evaluation cannot be proceeded due to invalid weight %s' % args.weight)
+        sys.exit()
     
-    r2i = R2I(args.targets)
-    r2i.collect_features(args.weight)
-    r2i.evaluate()
+    r2i = R2I(args.targets, args.jobs)
+    with r2i.stages.stage('evaluate.collect'):
+        r2i.collect_features(args.weight, args.format, args.matrix)
+    if args.sweep is not None:
+        weight = pd.read_csv(f'{sys.path[0]}/weight.csv', header=0, delimiter=',', index_col=0)
+        if args.sweep:
+            # random weights summing to 1, saved in the layout of weight.csv
+            weight = np.random.default_rng(0).dirichlet(np.ones(len(C_COL_NAMES[3:])), args.sweep).T
+            weight = pd.DataFrame(weight, index=pd.Index(C_COL_NAMES[3:], name='feature'),
+                                  columns=['random%d' % i for i in range(args.sweep)])
+            weight.to_csv('sweep_weight.csv')
+        with r2i.stages.stage('evaluate.sweep'):
+            r2i.sweep(weight).to_csv('sweep.csv', index=False)
+        print("[+] Successfully saved mean r2i and rank of each target under %d weights: sweep.csv" % weight.shape[1])
+    else:
+        r2i.evaluate()
+        if args.ranks:
+            r2i.R.to_csv('rank.csv', index=False)
+            print("[+] Successfully saved ranks of common functions: rank.csv")
+    r2i.stages.report()
 
-    os.remove('aggregated.csv')
+    if args.matrix:
+        for target_name in ['aggregated.npy', 'aggregated.idx.csv', 'aggregated.json']:
+            os.remove(target_name)
+    else:
+        os.remove('aggregated.' + args.format)
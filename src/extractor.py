@@ -3,12 +3,21 @@ import os
 import argparse
 import json
 import re
-from pycparser import c_ast, parse_file
+import hashlib
+import functools
+import multiprocessing
+import pandas as pd
+from pycparser import c_ast, preprocess_file
+from catalog import Catalog
+from cache import build_tables, make_parser, parse_cached, parse_with_prelude, load_features, store_features
+from preprocessor import preprocess
+from stream import Sources, iter_parse, preprocess_lines, split_external
+from timing import Stages
 
 PREDEF = {
-    'excluded': ['FileAST', 'Typename', 'TypeDecl', 'IdentifierType', 'FuncDef'],
-    'loops': ['For', 'While', 'DoWhile'],
-    'mem_functions': ['scanf', 'gets', 'fgets', 'free', 'memset', 'write', 'fwrite', 'read', 'fread']
+    'excluded': {'FileAST', 'Typename', 'TypeDecl', 'IdentifierType', 'FuncDef'},
+    'loops': {'For', 'While', 'DoWhile'},
+    'mem_functions': {'scanf', 'gets', 'fgets', 'free', 'memset', 'write', 'fwrite', 'read', 'fread'}
 }
 
 FEATURES_HDR = [
@@ -45,25 +54,79 @@ INIT_OPTION = {
     'FuncCmpB': False,
 }
 
-INVALID_TYPES = ['undefined', 'code', 'passwd', 'BADSPACEBASE', 'unkint', 'unkbyte10', '_UNKNOWN']
+INVALID_TYPES = {'undefined', 'code', 'passwd', 'BADSPACEBASE', 'unkint', 'unkbyte10', '_UNKNOWN'}
+
+# steps of Code.walk
+(VISIT, CHILD, LEAVE) = range(3)
+
+# nodes that write to their own copy of the options even without children
+WRITES_DETECT = {'Decl', 'Compound', 'Cast', 'For', 'While', 'DoWhile', 'If', 'UnaryOp', 'FuncCall', 'ExprList'}
+
+INCLUDE_DIR = r'pycparser/utils/fake_libc_include'
+
+with open(__file__, 'rb') as f:
+    FEATURES_VERSION = hashlib.sha1(f.read()).hexdigest()
 
 class Code(c_ast.Node):
-    def __init__(self, ast, filename, catalog):
+    def __init__(self, ast, filename, catalog, cache=None, stages=None, sources=None):
         self.ast = ast
         self.filename = filename
         self.catalog = catalog
+        self.cache = cache
+        self.sources = sources
+        self.stages = stages if stages is not None else Stages()
+        self.cached = {}
         self.functions = []
         self.scores = []
 
     def show(self):
-        self.ast.show(attrnames=True, nodenames=True)
+        if isinstance(self.ast, c_ast.Node):
+            self.ast.show(attrnames=True, nodenames=True)
 
         for (func, score) in self.scores:
             print('\n', func, score)
     
     def extract(self):
-        for (order, func) in self.ast.children():
+        # ast is either a FileAST or an iterator over its children when streamed
+        nodes = self.ast.children() if isinstance(self.ast, c_ast.Node) else self.ast
+        for (order, func) in nodes:
             if (func.__class__.__name__ == 'FuncDef'):
+                funcName = func.decl.name
+                funcCode = None
+                if self.catalog is not None:
+                    if funcName == 'nullsub_1':
+                        funcName = 'null_'
+                    elif re.search(r'^(thunk_.+|j_.+)', funcName):
+                        funcName = 'thunk_'
+                    elif funcName in ['thread_entry', 'start_routine']:
+                        funcName = 'pthread_'
+                    elif funcName.startswith('_obstack'):
+                        funcName = funcName[1:]
+
+                    with self.stages.stage('catalog'):
+                        info = self.catalog.pop(funcName)
+                    if info is not None:
+                        funcName = info['funcName']
+                        funcCode = info['decompiledFuncCode']
+                        if funcName == 'main':
+                            funcName = 'main_' + info['funcStartAddr'][2:]
+                    if funcCode is None:
+                        if not funcName in self.functions:
+                            print('[-] %s not found in %s' % (funcName, self.filename[:-1]+'json'), file=sys.stderr)
+                        continue
+
+                # keyed on the text the function was parsed from, as well as on
+                # its decompiled code that loc and lol are counted on
+                key = None
+                source = self.sources.digest(func.coord) if self.sources is not None else None
+                if self.cache is not None and funcCode is not None and source is not None:
+                    key = hashlib.sha1((FEATURES_VERSION + funcName + funcCode + source).encode()).hexdigest()
+                    if key in self.cache:
+                        self.cached[key] = self.cache[key]
+                        self.functions.append(funcName)
+                        self.scores.append((funcName, self.cache[key]))
+                        continue
+
                 score = {
                     'loc': 0,
                     'lol': 0,
@@ -99,44 +162,22 @@ class Code(c_ast.Node):
                     'invalid_funccall': 0,
                     'broken_dowhile': 0,
                 }
-                Code.walk(func, score, INIT_OPTION, order)
-                
-                funcName = score.pop('_func_name')
-                if self.catalog is not None:
-                    if funcName == 'nullsub_1':
-                        funcName = 'null_'
-                    elif re.search(r'^(thunk_.+|j_.+)', funcName):
-                        funcName = 'thunk_'
-                    elif funcName in ['thread_entry', 'start_routine']:
-                        funcName = 'pthread_'
-                    elif funcName.startswith('_obstack'):
-                        funcName = funcName[1:]
+                with self.stages.stage('walk'):
+                    Code.walk(func, score, INIT_OPTION, order)
+                score.pop('_func_name')
 
-                    funcCode = None
-                    for func in self.catalog:
-                        if func['funcName'].startswith(funcName):
-                            funcName = func['funcName']
-                            funcCode = func['decompiledFuncCode']
-                            if funcName == 'main':
-                                funcName = 'main_' + func['funcStartAddr'][2:]
-                            self.catalog.remove(func)
-                            break
-                    if funcCode is None:
-                        if not funcName in self.functions:
-                            print('[-] %s not found in %s' % (funcName, self.filename[:-1]+'json'), file=sys.stderr)
-                        continue
-                    else:
-                        def filterOut(line):
-                            if line == '':
-                                return False
-                            if line.startswith('#'):
-                                return False
-                            if line.endswith('*/') and line.lstrip().startswith('/*'):
-                                return False
-                            return True           
-                        lines = [x for x in funcCode.split('\n') if filterOut(x)]
-                        score['loc'] = len(lines)
-                        score['lol'] = max(len(re.split('[\s,:;\(\)\{\}]+', line.split('//', 1)[0].split('/*', 1)[0].strip())) for line in lines)
+                if self.catalog is not None:
+                    def filterOut(line):
+                        if line == '':
+                            return False
+                        if line.startswith('#'):
+                            return False
+                        if line.endswith('*/') and line.lstrip().startswith('/*'):
+                            return False
+                        return True           
+                    lines = [x for x in funcCode.split('\n') if filterOut(x)]
+                    score['loc'] = len(lines)
+                    score['lol'] = max(len(re.split('[\s,:;\(\)\{\}]+', line.split('//', 1)[0].split('/*', 1)[0].strip())) for line in lines)
 
                     score['label'] = len(score['label']['defined'] - score['label']['used'])
                     score['cond_depth'] = max(score['cond_depth'])
@@ -159,244 +200,368 @@ class Code(c_ast.Node):
                     total_fixes = score['fix']['pre'] + score['fix']['post']
                     score['fix'] = 0 if total_fixes == 0 else score['fix']['pre'] / total_fixes
 
+                if key is not None:
+                    self.cached[key] = score
                 self.functions.append(funcName)
                 self.scores.append((funcName, score))
         
     @staticmethod
     def walk(node, score, option, role):
-        token = node.__class__.__name__
-        detect = option.copy()
+        # Depth first with an explicit stack, as decompiled expressions nest too
+        # deep for recursion. Besides the nodes to visit, the stack holds the steps
+        # that follow each child (CHILD) and all children (LEAVE) of a node.
+        (excluded, loops, mem_functions) = (PREDEF['excluded'], PREDEF['loops'], PREDEF['mem_functions'])
+        stack = [(VISIT, node, role, option)]
+        (push, pop) = (stack.append, stack.pop)
+        while stack:
+            step = pop()
+            kind = step[0]
+
+            if kind == CHILD:
+                (_, node, role, detect, child) = step
+                child_op = getattr(child, 'op', '')
+                if role == 'cond[and][or]' and child_op not in {'&&', '||'}:
+                    detect['Cond'] += 1
+
+                elif detect['FuncCmpB']:
+                    if child.__class__.__name__ == 'FuncCall':
+                        continue
+                    
+                    elif getattr(node, 'op', '') == '==' and \
+                        child.__class__.__name__ == 'Constant' and \
+                        getattr(child, 'value', '') == '0':
+                        score['strcmp_']['not'] += 1
+                    else:
+                        score['strcmp_']['bare'] += 1
+                continue
+
+            if kind == LEAVE:
+                (_, token, role, detect, option) = step
+                if role == 'cond[and][or]':
+                    option['Cond'] = detect['Cond']
+                
+                elif token == 'If':
+                    score['cond_depth'].append(detect['Cond'])
+                
+                elif token == 'FuncCall' and detect['FuncCall']:
+                    option['FuncCmpB'] = detect['FuncCmpB']
+                continue
+
+            (_, node, role, option) = step
+            token = node.__class__.__name__
+            children = node.children()
+            # the options of a node are only copied when its children get them or
+            # it changes them, as most leaves just read them
+            detect = option.copy() if children or token in WRITES_DETECT else option
         
-        if token not in PREDEF['excluded']:
-            score['token'] += 1
+            if token not in excluded:
+                score['token'] += 1
 
-            if detect['Name'] and token == 'Decl':
-                score['_func_name'] = getattr(node, 'name', role)
-                detect['Name'] = option['Name'] = False
+                if detect['Name'] and token == 'Decl':
+                    score['_func_name'] = getattr(node, 'name', role)
+                    detect['Name'] = option['Name'] = False
 
-            elif token == 'Compound':
-                detect['Decl'] = True
+                elif token == 'Compound':
+                    detect['Decl'] = True
 
-                if role == 'iffalse':
-                    score['branch']['if'] += 1
+                    if role == 'iffalse':
+                        score['branch']['if'] += 1
 
-                    score['if_depth'].append(detect['IfNested'])
-
-            elif detect['Decl'] and token == 'Decl':
-                score['local'] += 1
-                detect['Init'] = True
-
-            elif detect['Init'] and role == 'init':
-                score['assignment'] += 1
-
-            elif token == 'Goto':
-                score['goto'] += 1
-
-                score['label']['used'].add(getattr(node, 'name', ''))
-            elif token == 'Label':
-                score['label']['defined'].add(getattr(node, 'name', ''))
-
-            elif token == 'Cast':
-                if detect['Cast']:
-                    if option['CastNested']:
-                        score['cast'] += 1
-                        option['CastNested'] = False
-                else:
-                    detect['Cast'] = True
-
-            elif token in PREDEF['loops']:
-                score['loop'][token.lower()] += 1
-                detect['If'] = True
-
-                detect['LoopNested'] += 1
-                if detect['LoopNested'] > score['loop_depth'][-1]:
-                    score['loop_depth'][-1] += 1
-                else:
-                    score['loop_depth'].append(detect['LoopNested'])
-
-            elif token == 'If':
-                score['branch']['if'] += 1
-                detect['BinaryOp'] = True
-
-                if detect['If']:
-                    score['if_in_loop'] += 1
-                    option['If'] = detect['If'] = False
-
-                if role != 'iffalse':
-                    detect['IfNested'] += 1
-                if detect['IfNested'] > score['if_depth'][-1]:
-                    score['if_depth'][-1] += 1
-                else:
-                    score['if_depth'].append(detect['IfNested'])
-            
-            elif token in ['Case', 'Default']:
-                score['branch']['case'] += 1
+                        score['if_depth'].append(detect['IfNested'])
 
-            elif token == 'TernaryOp':
-                score['branch']['ternary'] += 1
-                score['operator'] += 1
+                elif detect['Decl'] and token == 'Decl':
+                    score['local'] += 1
+                    detect['Init'] = True
 
-            elif token in ['ArrayRef', 'StructRef']:
-                score['ref']['structured'] += 1
+                elif detect['Init'] and role == 'init':
+                    score['assignment'] += 1
 
-            elif token == 'UnaryOp':
-                op = getattr(node, 'op', '')
+                # the other branches are on distinct tokens, the most frequent first
+                elif token == 'ID':
+                    if detect['FuncID'] and role == 'name':
+                        name = getattr(node, 'name', '')
 
-                if op == '*':
-                    score['ref']['direct'] += 1
+                        if name == 'invalid_funccall':
+                            score['invalid_funccall'] += 1
 
-                elif op == '&' and detect['MemRef']:
-                    score['ref']['direct'] += 1
+                        elif '__asm' in name:
+                            score['asm'] += 1
 
-                elif op in ['p++', 'p--']:
-                    score['fix']['pre'] += 1
-                    score['operator'] += 1
-                elif op in ['++', '--']:
-                    score['fix']['post'] += 1
-                    score['operator'] += 1
+                        elif name in {'strcmp', 'strncmp'}:
+                            if detect['FuncCmpU']:
+                                score['strcmp_']['not'] += 1
+                            elif not detect['FuncCall']:
+                                score['strcmp_']['bare'] += 1
+                            else:
+                                option['FuncCmpB'] = True
 
-                elif op == '!':
-                    detect['FuncCmpU'] = True
-                    score['operator'] += 1
-                
-                elif op == '~':
-                    score['bitwise'] += 1
+                        elif name in mem_functions:
+                            option['MemRef'] = False
+                        option['FuncID'] = False
+
+                    else:
+                        name = getattr(node, 'name', '').lower()
+                        if name in score:
+                            score[name] += 1
+
+                elif token == 'Constant':
+                    pass
+
+                elif token == 'BinaryOp':
                     score['operator'] += 1
-                        
-            elif token == 'BinaryOp':
-                score['operator'] += 1
-                op = getattr(node, 'op', '')
+                    op = getattr(node, 'op', '')
 
-                if op in ['&', '|', '^', '<<', '>>']:
-                    score['bitwise'] += 1
+                    if op in {'&', '|', '^', '<<', '>>'}:
+                        score['bitwise'] += 1
                 
-                elif detect['BinaryOp'] and op in ['&&', '||']:
-                    role = 'cond[and][or]'
+                    elif detect['BinaryOp'] and op in {'&&', '||'}:
+                        role = 'cond[and][or]'
 
-                elif op == '==':
-                    detect['FuncCall'] = True
+                    elif op == '==':
+                        detect['FuncCall'] = True
 
-            elif token == 'Assignment':
-                score['assignment'] += 1
+                elif token == 'Assignment':
+                    score['assignment'] += 1
 
-                op = getattr(node, 'op', '')
-                if op != '=':
-                    score['operator'] += 1
+                    op = getattr(node, 'op', '')
+                    if op != '=':
+                        score['operator'] += 1
 
-                    if op in ['&=', '|=', '^=', '<<=', '>>=']:
-                        score['bitwise'] += 1
+                        if op in {'&=', '|=', '^=', '<<=', '>>='}:
+                            score['bitwise'] += 1
 
-            elif token == 'FuncCall':
-                detect['FuncID'] = True
-                detect['ExprList'] = False
+                elif token == 'Goto':
+                    score['goto'] += 1
 
-            elif detect['FuncID'] and token == 'ID' and role == 'name':
-                name = getattr(node, 'name', '')
+                    score['label']['used'].add(getattr(node, 'name', ''))
+                elif token == 'Label':
+                    score['label']['defined'].add(getattr(node, 'name', ''))
 
-                if name == 'invalid_funccall':
-                    score['invalid_funccall'] += 1
+                elif token == 'Cast':
+                    if detect['Cast']:
+                        if option['CastNested']:
+                            score['cast'] += 1
+                            option['CastNested'] = False
+                    else:
+                        detect['Cast'] = True
 
-                elif '__asm' in name:
-                    score['asm'] += 1
+                elif token in loops:
+                    score['loop'][token.lower()] += 1
+                    detect['If'] = True
 
-                elif name in ['strcmp', 'strncmp']:
-                    if detect['FuncCmpU']:
-                        score['strcmp_']['not'] += 1
-                    elif not detect['FuncCall']:
-                        score['strcmp_']['bare'] += 1
+                    detect['LoopNested'] += 1
+                    if detect['LoopNested'] > score['loop_depth'][-1]:
+                        score['loop_depth'][-1] += 1
                     else:
-                        option['FuncCmpB'] = True
-                
-                elif name in PREDEF['mem_functions']:
-                    option['MemRef'] = False
-                option['FuncID'] = False
+                        score['loop_depth'].append(detect['LoopNested'])
+
+                elif token == 'If':
+                    score['branch']['if'] += 1
+                    detect['BinaryOp'] = True
+
+                    if detect['If']:
+                        score['if_in_loop'] += 1
+                        option['If'] = detect['If'] = False
+
+                    if role != 'iffalse':
+                        detect['IfNested'] += 1
+                    if detect['IfNested'] > score['if_depth'][-1]:
+                        score['if_depth'][-1] += 1
+                    else:
+                        score['if_depth'].append(detect['IfNested'])
             
-            elif token == 'ID':
-                name = getattr(node, 'name', '').lower()
-                if name in score.keys():
-                    score[name] += 1
-
-            elif detect['ExprList'] and token == 'ExprList':
-                score['comma'] += 1
-                detect['ExprList'] = False
-        
-        if token == 'IdentifierType':
-            types = getattr(node, 'names', [])
-            for _type in types:
-                if _type in INVALID_TYPES:
-                    score['undefined'] += 1
-        
-        elif role == 'cond' and token != 'FuncCall':
-            detect['ExprList'] = True
+                elif token in {'Case', 'Default'}:
+                    score['branch']['case'] += 1
 
-            value = getattr(node, 'value', 'NaN')
-            if not (value.isnumeric() and float(value)):
-                option['If'] = False
+                elif token == 'TernaryOp':
+                    score['branch']['ternary'] += 1
+                    score['operator'] += 1
 
-        if token != 'If' and role != 'cond[and][or]':
-            detect['BinaryOp'] = False
-        
-        for (child_role, child) in node.children():
-            Code.walk(child, score, detect, child_role)
+                elif token in {'ArrayRef', 'StructRef'}:
+                    score['ref']['structured'] += 1
 
-            child_op = getattr(child, 'op', '')
-            if role == 'cond[and][or]' and child_op not in ['&&', '||']:
-                detect['Cond'] += 1
+                elif token == 'UnaryOp':
+                    op = getattr(node, 'op', '')
 
-            elif detect['FuncCmpB'] and token == 'BinaryOp':
-                if child.__class__.__name__ == 'FuncCall':
-                    continue
+                    if op == '*':
+                        score['ref']['direct'] += 1
+
+                    elif op == '&' and detect['MemRef']:
+                        score['ref']['direct'] += 1
+
+                    elif op in {'p++', 'p--'}:
+                        score['fix']['pre'] += 1
+                        score['operator'] += 1
+                    elif op in {'++', '--'}:
+                        score['fix']['post'] += 1
+                        score['operator'] += 1
+
+                    elif op == '!':
+                        detect['FuncCmpU'] = True
+                        score['operator'] += 1
                 
-                elif getattr(node, 'op', '') == '==' and \
-                    child.__class__.__name__ == 'Constant' and \
-                    getattr(child, 'value', '') == '0':
-                    score['strcmp_']['not'] += 1
-                else:
-                    score['strcmp_']['bare'] += 1
+                    elif op == '~':
+                        score['bitwise'] += 1
+                        score['operator'] += 1
+                        
+                elif token == 'FuncCall':
+                    detect['FuncID'] = True
+                    detect['ExprList'] = False
+
+                elif detect['ExprList'] and token == 'ExprList':
+                    score['comma'] += 1
+                    detect['ExprList'] = False
         
-        if role == 'cond[and][or]':
-            option['Cond'] = detect['Cond']
+            if token == 'IdentifierType':
+                types = getattr(node, 'names', [])
+                for _type in types:
+                    if _type in INVALID_TYPES:
+                        score['undefined'] += 1
         
-        elif token == 'If':
-            score['cond_depth'].append(detect['Cond'])
+            elif role == 'cond' and token != 'FuncCall':
+                # what a leaf sets in its options is never read
+                if children:
+                    detect['ExprList'] = True
+
+                value = getattr(node, 'value', 'NaN')
+                if not (value.isnumeric() and float(value)):
+                    option['If'] = False
+
+            if children and token != 'If' and role != 'cond[and][or]':
+                detect['BinaryOp'] = False
         
-        elif token == 'FuncCall' and detect['FuncCall']:
-            option['FuncCmpB'] = detect['FuncCmpB']
+            if token == 'If' or token == 'FuncCall' or role == 'cond[and][or]':
+                push((LEAVE, token, role, detect, option))
+
+            # pushed in reverse so that children are visited in order, each one
+            # followed by its step on the parent (only BinaryOp has one)
+            if token == 'BinaryOp':
+                for (child_role, child) in reversed(children):
+                    push((CHILD, node, role, detect, child))
+                    push((VISIT, child, child_role, detect))
+            else:
+                for (child_role, child) in reversed(children):
+                    push((VISIT, child, child_role, detect))
     
-    def save(self, path):
+    @staticmethod
+    def values(score):
+        values = []
+        for k in sorted(score.keys()):
+            if isinstance(score[k], dict):
+                for x in sorted(score[k]):
+                    values.append(score[k][x])
+            else:
+                values.append(score[k])
+        return values
+
+    def save(self, path, fmt='csv'):
         def _write_hdr(f):
             for feature in sorted(FEATURES_HDR):
                 f.write('%s, ' % feature)
             f.write('\n')
 
-        target_name = os.path.join('extract', path, self.filename[:-1]+'csv')
+        target_name = os.path.join('extract', path, self.filename[:-1]+fmt)
+        if fmt == 'parquet':
+            # the columns of the csv, typed the way read_csv would infer them
+            rows = [[func] + Code.values(score) for (func, score) in self.scores]
+            pd.DataFrame(rows, columns=sorted(FEATURES_HDR)).to_parquet(target_name, index=False)
+            return
+
         with open(target_name, "w") as f:
             _write_hdr(f)
             for (func, score) in self.scores:
                 f.write('%s, ' % func)
-                for k in sorted(score.keys()):
-                    if isinstance(score[k], dict):
-                        for x in sorted(score[k]):
-                            f.write('%s, ' % score[k][x])
-                    else:
-                        f.write('%s, ' % score[k])
+                for value in Code.values(score):
+                    f.write('%s, ' % value)
                 f.write('\n')
 
-def extract(path, filename, debug, save):
+def extract(path, filename, debug, save, parser=None, cache=False, incremental=False, cpp='gcc', prelude=False,
+            stream=False, fmt='csv'):
     target_name = os.path.join('dataset', path, 'syntax_correction', filename) if not debug else filename
-    ast = parse_file(target_name, use_cpp=True,
-            cpp_path='gcc',
-            cpp_args=['-E', r'-Ipycparser/utils/fake_libc_include'])
-    catalog = parse_json(filename, path) if not debug else None
-    code = Code(ast, filename, catalog)
-    code.extract()
+    if parser is None:
+        parser = make_parser()
+    stages = Stages(decompiler=os.path.basename(path), file=filename)
+    sources = Sources() if incremental else None
+    # in streaming mode the file is preprocessed and parsed along with the
+    # extraction, and timed as the lines and the declarations are taken
+    if stream:
+        if cpp == 'ply':
+            with stages.stage('preprocess'):
+                lines = preprocess(target_name, [INCLUDE_DIR]).splitlines(keepends=True)
+        else:
+            lines = stages.iterate('preprocess', preprocess_lines(target_name, cpp, ['-E', '-I' + INCLUDE_DIR]))
+        ast = stages.iterate('parse', iter_parse(parser, lines, target_name, sources))
+    else:
+        with stages.stage('preprocess'):
+            if cpp == 'ply':
+                text = preprocess(target_name, [INCLUDE_DIR])
+            else:
+                text = preprocess_file(target_name, cpp, ['-E', '-I' + INCLUDE_DIR])
+        # lexing and LALR parsing, tokens are lexed as the parser asks for them
+        with stages.stage('parse'):
+            parse = functools.partial(parse_with_prelude, parser) if prelude else parser.parse
+            ast = parse_cached(parse, text, target_name) if cache else parse(text, target_name)
+        if sources is not None:
+            with stages.stage('sources'):
+                for chunk in split_external(text.splitlines(keepends=True)):
+                    sources.add(chunk)
+    with stages.stage('catalog'):
+        catalog = Catalog(parse_json(filename, path)) if not debug else None
+    code = Code(ast, filename, catalog, load_features(target_name) if incremental else None, stages, sources)
+    with stages.stage('extract'):
+        code.extract()
+    if incremental:
+        store_features(target_name, code.cached)
     
     if debug:
         code.show()
     elif save:
-        code.save(path)
+        with stages.stage('save'):
+            code.save(path, fmt)
+    stages.report()
     return code.scores
 
+def batch(experiment, decompilers, save, jobs=1, **options):
+    tasks = []
+    for decompiler in decompilers:
+        path = os.path.join(experiment, decompiler)
+        if save:
+            os.makedirs(os.path.join('extract', path), exist_ok=True)
+
+        source_dir = os.path.join('dataset', path, 'syntax_correction')
+        tasks.extend((path, x, save, options) for x in sorted(os.listdir(source_dir)) if x.endswith('.c'))
+
+    build_tables()
+    if jobs > 1:
+        with multiprocessing.Pool(jobs, initializer=_init_worker) as pool:
+            _report(pool.imap_unordered(_extract_task, tasks), len(tasks), options.get('fmt', 'csv'))
+    else:
+        _init_worker()
+        _report(map(_extract_task, tasks), len(tasks), options.get('fmt', 'csv'))
+    print('\n[+] finish extract')
+
+_parser = None
+
+def _init_worker():
+    global _parser
+    _parser = make_parser()
+
+def _extract_task(task):
+    (path, filename, save, options) = task
+    try:
+        extract(path, filename, False, save, _parser, **options)
+    except Exception as e:
+        return (path, filename, str(e))
+    return (path, filename, None)
+
+def _report(results, count, fmt):
+    for (i, (path, filename, error)) in enumerate(results):
+        target_name = os.path.join(path, filename)
+        if error is None:
+            print('[+] %d/%d... Feature scores of %s extracted in %s' % (i+1, count, target_name, fmt), flush=True)
+        else:
+            print('[-] %d/%d... Failed to extract %s: %s' % (i+1, count, target_name, error), file=sys.stderr, flush=True)
+
 def parse_json(filename, path):
     target_name = os.path.join('dataset', path, 'json', filename[:-1]+'json')
     with open(target_name, 'r') as f:
@@ -405,16 +570,45 @@ def parse_json(filename, path):
 if __name__ == '__main__':
     os.chdir(os.path.dirname(sys.path[0]))
     
-    parser = argparse.ArgumentParser(usage='extractor.py [-h] [-d | -s] [-p path] filename')
-    parser.add_argument('filename', type=str)
+    parser = argparse.ArgumentParser(usage='extractor.py [-h] [-d | -s] [-c] [-i] [--cpp cpp] [--prelude] [--stream] [-f format] [-p path] filename\n'
+                                           '       extractor.py [-h] [-s] [-c] [-i] [--cpp cpp] [--prelude] [--stream] [-f format] [-j jobs] -b experiment decompiler [decompiler ...]')
+    parser.add_argument('filename', type=str, nargs='?')
     parser.add_argument('-p', '--path', action='store', default='',
                             help='set path to which the code can be found')
     parser.add_argument('-d', '--debug', action='store_true', default=False,
                             help='run program in debug mode')
     parser.add_argument('-s', '--save', action='store_true', default=False,
                             help='save the program execution result into a file')
+    parser.add_argument('-c', '--cache', action='store_true', default=False,
+                            help='reuse cached ASTs of unchanged preprocessed sources')
+    parser.add_argument('-i', '--incremental', action='store_true', default=False,
+                            help='reuse cached feature scores of unchanged functions')
+    parser.add_argument('--cpp', action='store', default='gcc',
+                            help="set C preprocessor to run, or 'ply' to preprocess in-process")
+    parser.add_argument('--prelude', action='store_true', default=False,
+                            help='parse the leading #include once and resume each file from its snapshot')
+    parser.add_argument('--stream', action='store_true', default=False,
+                            help='parse and score one top-level declaration at a time (ignores -c and --prelude)')
+    parser.add_argument('-f', '--format', choices=['csv', 'parquet'], default='csv',
+                            help='save feature scores as csv or as typed parquet files (needs pyarrow)')
+    parser.add_argument('-b', '--batch', nargs='+', metavar=('experiment', 'decompiler'),
+                            help='extract every file of the given decompilers with a single parser')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='number of worker processes used in batch mode')
     args = parser.parse_args()
     if args.debug and args.save:
         parser.print_usage()
-    
-    extract(args.path, args.filename, args.debug, args.save)
+
+    if args.batch:
+        if len(args.batch) < 2 or args.debug:
+            parser.print_usage()
+            sys.exit(1)
+        batch(args.batch[0], args.batch[1:], args.save, args.jobs,
+              cache=args.cache, incremental=args.incremental,
+              cpp=args.cpp, prelude=args.prelude, stream=args.stream, fmt=args.format)
+    elif args.filename:
+        extract(args.path, args.filename, args.debug, args.save,
+                cache=args.cache, incremental=args.incremental,
+                cpp=args.cpp, prelude=args.prelude, stream=args.stream, fmt=args.format)
+    else:
+        parser.print_usage()
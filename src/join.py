@@ -0,0 +1,46 @@
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+# rows of a partition of the functions, split by a hash of (binary, address)
+PARTITION_ROWS = 1000000
+
+def partition(keys, partitions):
+    """ Split the rows of keys by a hash of (binary, address) so that the rows
+        of a function all fall into the same partition. Returns the positions
+        of the rows of each partition in their original order.
+    """
+    if partitions == 1:
+        return [np.arange(len(keys))]
+    h = pd.util.hash_pandas_object(keys[['binary', 'address']], index=False).to_numpy() % partitions
+    order = np.argsort(h, kind='stable')
+    bounds = np.searchsorted(h[order], np.arange(partitions + 1))
+    return [order[lo:hi] for (lo, hi) in zip(bounds[:-1], bounds[1:])]
+
+def _join_task(task):
+    (keys, count) = task
+    size = keys.groupby(['binary', 'address'], sort=False, dropna=False)['decompiler'].transform('size')
+    complete = (size == count).to_numpy()
+    return (complete, keys['decompiler'][~complete].value_counts())
+
+def join(keys, targets, jobs=1):
+    """ Find the functions every target decompiled. keys holds one row per
+        decompiler and function (decompiler, binary, address), and the rows
+        of complete functions are given as a mask, along with the number of
+        functions of each target left out for missing in another one.
+    """
+    # a partition for each worker at least
+    parts = partition(keys, max(jobs, -(-len(keys) // PARTITION_ROWS)))
+    tasks = [(keys.iloc[p], len(targets)) for p in parts]
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            results = pool.map(_join_task, tasks)
+    else:
+        results = map(_join_task, tasks)
+
+    complete = np.zeros(len(keys), dtype=bool)
+    dropped = pd.Series(0, index=targets)
+    for (p, (c, d)) in zip(parts, results):
+        complete[p] = c
+        dropped = dropped.add(d, fill_value=0)
+    return (complete, dropped.astype(int))
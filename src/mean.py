@@ -1,45 +1,52 @@
 import os
+import io
 import sys
 import pandas as pd
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from timing import Stages
+
+def read(filename):
+    with open(filename, 'r') as f:
+        return f.read()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('experiment', type=str)
     parser.add_argument('-t', '--targets', nargs='+', required=True,
                             help='specify targets to relatively aggregate')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='number of threads reading the evaluation on each binary')
     args = parser.parse_args()
     
     targets = args.targets
     maxr = len(targets)
     assert(maxr > 1)
     
-    data = []
+    stages = Stages(experiment=args.experiment)
     os.chdir(os.path.join(os.path.dirname(sys.path[0]), 'eval', args.experiment, 'bin'))
-    for filename in os.listdir():
-        b = pd.read_csv(filename, header=0, delimiter=',')
-        data.append(b)
-    data = pd.concat(data, axis=0)
+    # the files are read at once in the order listed and their rows parsed
+    # together under the header of the first one
+    with stages.stage('mean.read'):
+        with ThreadPoolExecutor(args.jobs) as pool:
+            texts = list(pool.map(read, os.listdir()))
+        data = pd.read_csv(io.StringIO(texts[0] + ''.join(text.split('\n', 1)[1] for text in texts[1:])),
+                           header=0, delimiter=',')
 
-    index = data.filter(['decompiler', 'binary'])
-    data = index.join(data.groupby(by=['decompiler', 'binary'])['r2i'].mean(), on=['decompiler', 'binary'])
-    data = data.drop_duplicates()
+    # mean of each target on each binary, in order of appearance
+    with stages.stage('mean.mean'):
+        data = data.groupby(['decompiler', 'binary'], sort=False)['r2i'].mean().reset_index()
     with open(f'../mean.csv', 'w') as f:
         data.to_csv(f, index=False)
 
-    ranks = []
-    for i in range(len(data) // 6):
-        i *= 6
-        ranks.extend(list(data.iloc[i:i+6, 2].rank(method='min', ascending=False)))
-    data['rank'] = ranks
-
-    ranked = {}
-    for decompiler in targets:
-        ranked[decompiler] = [0] * (maxr)
-    for dv in data.values:
-        ranked[dv[0]][int(dv[3])-1] += 1
-    ranked = pd.DataFrame(ranked)
+    # rank of each target within every binary, and how often it got each rank
+    with stages.stage('mean.rank'):
+        data['rank'] = data.groupby('binary', sort=False)['r2i'].rank(method='min', ascending=False).astype(int)
+        ranked = pd.crosstab(data['rank'], data['decompiler'])
+        ranked = ranked.reindex(index=range(1, maxr + 1), columns=targets, fill_value=0)
+        ranked = ranked.reset_index(drop=True).rename_axis(None, axis=1)
     with open(f'../rom.csv', 'w') as f:
         ranked.to_csv(f, index=False)
     print(ranked)
-    os.remove('../rom.csv')
\ No newline at end of file
+    os.remove('../rom.csv')
+    stages.report()
\ No newline at end of file
@@ -0,0 +1,70 @@
+import os
+from pycparser.ply import lex, cpp
+
+# Expanded headers shared by every Preprocessor of this process, keyed on
+# the include directive, the search path and the macros defined beforehand
+HEADERS = {}
+
+# Macros whose value differs between translation units without affecting headers
+VOLATILE_MACROS = ['__FILE__', '__DATE__', '__TIME__']
+
+# built by the first Preprocessor, so that importing this module costs nothing
+_lexer = None
+
+class Preprocessor(cpp.Preprocessor):
+    def __init__(self, include_dirs):
+        global _lexer
+        if _lexer is None:
+            _lexer = lex.lex(module=cpp)
+        super().__init__(_lexer.clone())
+        for path in include_dirs:
+            self.add_path(path)
+
+    def include(self, tokens):
+        source = self.source
+        key = (''.join(str(x.value) for x in tokens), tuple(self.path), tuple(self.temp_path),
+               frozenset((name, Preprocessor.signature(macro)) for (name, macro) in self.macros.items()
+                         if name not in VOLATILE_MACROS))
+        if key not in HEADERS:
+            before = dict(self.macros)
+            expanded = list(super().include(tokens))
+            defined = {name: macro for (name, macro) in self.macros.items()
+                       if before.get(name) is not macro and name not in VOLATILE_MACROS}
+            removed = [name for name in before if name not in self.macros]
+            HEADERS[key] = (expanded, defined, removed)
+
+        (expanded, defined, removed) = HEADERS[key]
+        self.macros.update(defined)
+        for name in removed:
+            self.macros.pop(name, None)
+
+        # gcc style line markers, which also delimit the prelude of a file
+        header = ''.join(str(x.value) for x in tokens).strip('"<>')
+        yield Preprocessor.marker('\n# 1 "%s" 1\n' % header)
+        yield from expanded
+        yield Preprocessor.marker('\n# %d "%s" 2\n' % (tokens[0].lineno + 1, source))
+
+    @staticmethod
+    def marker(text):
+        tok = lex.LexToken()
+        tok.type = 'CPP_WS'
+        tok.value = text
+        tok.lineno = tok.lexpos = 0
+        return tok
+
+    @staticmethod
+    def signature(macro):
+        if not hasattr(macro, 'signature'):
+            macro.signature = (tuple(str(x.value) for x in macro.value),
+                               tuple(macro.arglist or ()), macro.variadic)
+        return macro.signature
+
+def preprocess(filename, include_dirs):
+    with open(filename, 'r') as f:
+        text = f.read()
+
+    pp = Preprocessor(include_dirs)
+    # like cpp, quoted includes are looked up next to the including file first
+    pp.temp_path.insert(0, os.path.dirname(filename))
+    pp.parse(text, filename)
+    return '# 1 "%s"\n' % filename + ''.join(str(x.value) for x in pp.parser)
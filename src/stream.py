@@ -0,0 +1,132 @@
+import re
+import bisect
+import hashlib
+import subprocess
+
+from cache import LINE_MARKER
+
+# '=' is tracked only so that the '{' of an initializer is not taken for a body
+TOKEN = re.compile(r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|[{}()\[\];=]')
+
+def preprocess_lines(filename, cpp_path, cpp_args):
+    """ Yield the preprocessed lines of filename as the preprocessor writes them
+    """
+    with subprocess.Popen([cpp_path] + cpp_args + [filename],
+                          stdout=subprocess.PIPE, universal_newlines=True) as proc:
+        yield from proc.stdout
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+def split_external(lines):
+    r""" Group preprocessed lines into chunks of complete top-level declarations
+        and function definitions. Each chunk starts with a line marker so that
+        coordinates stay right when it is parsed on its own.
+
+        >>> lines = ['int (*tbl[2])(int) = {\n', ' sub_1\n', '}\n', ';\n', 'int f() {}\n']
+        >>> [x.split('\n', 1)[1] for x in split_external(lines)]
+        ['int (*tbl[2])(int) = {\n sub_1\n}\n;\n', 'int f() {}\n']
+    """
+    (filename, lineno) = ('', 1)
+    chunk = []
+    depth = 0
+    body = []
+    prev = None
+    for line in lines:
+        if not chunk:
+            chunk.append('# %d "%s"\n' % (lineno, filename))
+        chunk.append(line)
+
+        if line.lstrip().startswith('#'):
+            m = LINE_MARKER.match(line)
+            if m:
+                (filename, lineno) = (m.group(1), int(line.split()[1]))
+            else:
+                lineno += 1
+            continue
+        lineno += 1
+
+        complete = False
+        for m in TOKEN.finditer(line):
+            tok = m.group()
+            if tok in '({[':
+                if tok == '{' and depth == 0:
+                    # only the body of a function definition ends a declaration
+                    body.append(prev == ')')
+                depth += 1
+                complete = False
+            elif tok in ')}]':
+                depth -= 1
+                complete = depth == 0 and tok == '}' and body.pop()
+            elif tok == ';':
+                complete = depth == 0
+            prev = tok
+
+        if complete:
+            yield ''.join(chunk)
+            chunk = []
+
+    if any(x.strip() and not LINE_MARKER.match(x) for x in chunk):
+        yield ''.join(chunk)
+
+class Sources(object):
+    """ Digests of the text the function definitions of a file were parsed
+        from, looked up by their coordinates among the chunks of
+        split_external. The digest of a function also covers the declarations
+        before it, the expanded headers among them, since they decide how its
+        text is parsed. Line markers and blank lines are left out so that
+        moving a function keeps its digest.
+    """
+    def __init__(self):
+        self.context = hashlib.sha1()
+        self.starts = {}
+        self.digests = {}
+
+    def add(self, chunk):
+        (filename, lineno, start) = ('', 1, None)
+        text = []
+        for line in chunk.splitlines(keepends=True):
+            m = LINE_MARKER.match(line)
+            if m:
+                if start is None:
+                    (filename, lineno) = (m.group(1), int(line.split()[1]))
+                continue
+            if start is None:
+                start = (filename, lineno)
+            if line.strip():
+                text.append(line)
+        if start is None:
+            return
+
+        text = ''.join(text).encode()
+        # only the body of a function definition ends a chunk with '}'
+        if chunk.rstrip().endswith('}'):
+            digest = self.context.copy()
+            digest.update(text)
+            self.starts.setdefault(start[0], []).append(start[1])
+            self.digests.setdefault(start[0], []).append(digest.hexdigest())
+        else:
+            self.context.update(text)
+
+    def digest(self, coord):
+        """ Returns None for a node out of the chunks added
+        """
+        if coord is None or coord.file not in self.starts:
+            return None
+        k = bisect.bisect_right(self.starts[coord.file], coord.line) - 1
+        return self.digests[coord.file][k] if k >= 0 else None
+
+def iter_parse(parser, lines, filename, sources=None):
+    """ Parse preprocessed lines one top-level declaration at a time and yield
+        ('ext[n]', node) like FileAST.children() would for the whole file.
+        Each chunk is also added to sources when given.
+    """
+    scope = None
+    n = 0
+    for chunk in split_external(lines):
+        if sources is not None:
+            sources.add(chunk)
+        ast = parser.parse(chunk, filename, scope=scope)
+        scope = parser._scope_stack[0]
+        for node in ast.ext:
+            yield ('ext[%d]' % n, node)
+            n += 1
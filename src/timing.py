@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# report the stages append their records to, one JSON object per line, left
+# off unless set
+REPORT = os.environ.get('R2I_TIMING')
+
+def cpu_time():
+    # of the process and of the children it waited for
+    return time.process_time() + sum(os.times()[2:4])
+
+def peak_rss():
+    """ Peak resident set size of the process so far in MB, None where the
+        platform does not tell
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+class Stages(object):
+    """ Wall and CPU time spent in named stages of a run, summed over every
+        time a stage is entered, along with the peak RSS of the process once
+        it was left. CPU time includes the children waited for, like the
+        preprocessor. A stage entered within another one is taken out of the
+        time of the outer one, so that the stages of a run add up. Labels such
+        as the decompiler and the file go with each record of the report.
+    """
+    def __init__(self, **labels):
+        self.labels = labels
+        self.times = {}
+        # wall and CPU time of the stages nested in each stage entered
+        self.nested = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not REPORT:
+            yield
+            return
+        self.nested.append([0.0, 0.0])
+        (wall, cpu) = (time.perf_counter(), cpu_time())
+        try:
+            yield
+        finally:
+            (wall, cpu) = (time.perf_counter() - wall, cpu_time() - cpu)
+            (nested_wall, nested_cpu) = self.nested.pop()
+            if self.nested:
+                self.nested[-1][0] += wall
+                self.nested[-1][1] += cpu
+            t = self.times.setdefault(name, {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'rss': None})
+            t['count'] += 1
+            t['wall'] += wall - nested_wall
+            t['cpu'] += cpu - nested_cpu
+            t['rss'] = peak_rss()
+
+    def iterate(self, name, iterable):
+        """ Yield the items of iterable, timing the production of each one as
+            stage name, for work done lazily as the items are asked for
+        """
+        if not REPORT:
+            yield from iterable
+            return
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def report(self):
+        if not REPORT:
+            return
+        with open(REPORT, 'a') as f:
+            for (name, t) in self.times.items():
+                f.write(json.dumps(dict(self.labels, stage=name, pid=os.getpid(), **t)) + '\n')
+        self.times = {}
+
+def summarize(report):
+    """ Totals of each stage for each decompiler, the peak RSS being the
+        largest of any process
+    """
+    import pandas as pd
+    records = pd.read_json(report, lines=True)
+    if 'decompiler' not in records.columns:
+        records['decompiler'] = None
+    summary = records.groupby(['stage', 'decompiler'], sort=False, dropna=False).agg(
+        records=('stage', 'size'), count=('count', 'sum'), wall=('wall', 'sum'), cpu=('cpu', 'sum'), rss=('rss', 'max'))
+    return summary.reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('report', type=str, help='stage records of a run (R2I_TIMING)')
+    args = parser.parse_args()
+
+    summary = summarize(args.report)
+    target_name = os.path.splitext(args.report)[0] + '.csv'
+    summary.to_csv(target_name, index=False)
+    print(summary.to_string(index=False))
+    print('[+] Successfully saved the time spent in each stage: %s' % target_name)